@@ -5,22 +5,30 @@ Provides a single endpoint to retrieve all agencies
 """
 
 import os
-import psycopg2
-import psycopg2.extras
+import asyncio
+import hashlib
+import json
+import re
+from functools import lru_cache
+from contextlib import asynccontextmanager
+import asyncpg
+import orjson
+from cachetools import TTLCache
 from typing import List, Dict, Optional
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
 from datetime import datetime
 import logging
-import openai
+from openai import AsyncOpenAI
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Configure OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY", "your key")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "your key")
 
 # Database configuration
 DB_HOST = os.getenv('DB_HOST', 'localhost')
@@ -28,6 +36,36 @@ DB_PORT = os.getenv('DB_PORT', '5432')
 DB_NAME = os.getenv('DB_NAME', 'ecfrdb')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'XYZ')
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '5'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '20'))
+DB_ACQUIRE_TIMEOUT = float(os.getenv('DB_ACQUIRE_TIMEOUT', '2.0'))
+# asyncpg prepares each distinct query once per connection and reuses it from this cache
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))
+# Rows fetched per round-trip when streaming word counts
+WORD_COUNTS_CHUNK_SIZE = int(os.getenv('WORD_COUNTS_CHUNK_SIZE', '500'))
+
+# The titles table is small and only changes on re-ingest, so keep it in memory
+TITLES_CACHE_TTL = int(os.getenv('TITLES_CACHE_TTL', '300'))
+_TITLES = TTLCache(maxsize=1, ttl=TITLES_CACHE_TTL)
+
+# HTTP Cache-Control max-age (seconds) for the read endpoints, by path prefix
+HTTP_CACHE_MAX_AGE = {
+    '/agencies': int(os.getenv('AGENCIES_CACHE_MAX_AGE', '300')),
+    '/word-count/': int(os.getenv('WORD_COUNTS_CACHE_MAX_AGE', '3600')),
+    '/word-counts/': int(os.getenv('WORD_COUNTS_CACHE_MAX_AGE', '3600')),
+}
+# Streamed responses get Cache-Control only; hashing them would mean buffering the stream
+STREAMED_PATH_PREFIXES = ('/word-counts/',)
+
+# Generated summaries, keyed by a hash of the request payload
+SUMMARY_CACHE_SIZE = int(os.getenv('SUMMARY_CACHE_SIZE', '1024'))
+SUMMARY_CACHE_TTL = int(os.getenv('SUMMARY_CACHE_TTL', '86400'))
+_SUMMARIES = TTLCache(maxsize=SUMMARY_CACHE_SIZE, ttl=SUMMARY_CACHE_TTL)
+_SUMMARY_TASKS: Dict[str, asyncio.Task] = {}
+# Maximum OpenAI calls in flight across all /ai/agency-summaries batches in this process
+SUMMARY_BATCH_CONCURRENCY = int(os.getenv('SUMMARY_BATCH_CONCURRENCY', '8'))
+# Maximum agencies accepted in one /ai/agency-summaries request
+SUMMARY_BATCH_MAX_SIZE = int(os.getenv('SUMMARY_BATCH_MAX_SIZE', '50'))
 
 # Pydantic models for API responses
 class WordCount(BaseModel):
@@ -62,13 +100,80 @@ class Agency(BaseModel):
     created_at: datetime
     updated_at: datetime
 
+async def init_connection(conn):
+    """Decode json/jsonb columns into Python objects on every pooled connection"""
+    for type_name in ('json', 'jsonb'):
+        await conn.set_type_codec(
+            type_name,
+            encoder=json.dumps,
+            decoder=orjson.loads,
+            schema='pg_catalog'
+        )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the database pool and OpenAI client on startup and close them on shutdown"""
+    app.state.pool = await asyncpg.create_pool(
+        host=DB_HOST,
+        port=int(DB_PORT),
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        init=init_connection
+    )
+    # One client for the whole process so its HTTP connection pool is reused
+    app.state.openai = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    # Shared by every summary batch; created here so it belongs to the server's event loop
+    app.state.summary_semaphore = asyncio.Semaphore(SUMMARY_BATCH_CONCURRENCY)
+    try:
+        yield
+    finally:
+        await app.state.openai.close()
+        await app.state.pool.close()
+
 # Initialize FastAPI app
 app = FastAPI(
     title="eCFR Agencies API",
     description="Simple API for retrieving all eCFR agencies",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
+# HTTP caching middleware; registered before CORS so 304s still carry CORS headers
+@app.middleware("http")
+async def http_cache_headers(request: Request, call_next):
+    """
+    Add Cache-Control and a content-hash ETag to read endpoints, answering 304 on If-None-Match
+    """
+    response = await call_next(request)
+    
+    path = request.url.path
+    max_age = next((age for prefix, age in HTTP_CACHE_MAX_AGE.items() if path.startswith(prefix)), None)
+    if request.method != "GET" or response.status_code != 200 or max_age is None:
+        return response
+    
+    cache_control = f"public, max-age={max_age}"
+    if path.startswith(STREAMED_PATH_PREFIXES):
+        response.headers["Cache-Control"] = cache_control
+        return response
+    
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    
+    if_none_match = request.headers.get("if-none-match", "")
+    client_etags = {tag.strip().replace("W/", "", 1) for tag in if_none_match.split(",")}
+    if etag in client_etags or "*" in client_etags:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+    
+    headers = dict(response.headers)
+    headers["ETag"] = etag
+    headers["Cache-Control"] = cache_control
+    return Response(content=body, status_code=response.status_code, headers=headers)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -78,176 +183,156 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Hot queries, kept as constants so every call hits the same prepared statement
+TITLES_QUERY = '''
+    SELECT title_number, title_name, latest_amended_on,
+           latest_issue_date, up_to_date_as_of
+    FROM titles
+'''
+
+# Agency columns, with and without the jsonb children / cfr_references
+AGENCY_COLUMNS = {
+    True: 'id, name, display_name, slug, children, cfr_references, created_at, updated_at',
+    False: 'id, name, display_name, slug, created_at, updated_at',
+}
+
+# WHERE clauses keyed by (filter by slug, filter by name)
+AGENCY_FILTERS = {
+    (False, False): '',
+    (True, False): ' WHERE slug = $1',
+    (False, True): ' WHERE name ILIKE $1',
+    (True, True): ' WHERE slug = $1 AND name ILIKE $2',
+}
+
+# Every /agencies query, keyed by (include_refs, filter by slug, filter by name)
+AGENCIES_QUERIES = {
+    (include_refs, by_slug, by_name): f'SELECT {columns} FROM agencies{where} ORDER BY name'
+    for include_refs, columns in AGENCY_COLUMNS.items()
+    for (by_slug, by_name), where in AGENCY_FILTERS.items()
+}
+
+WORD_COUNT_QUERY = '''
+    SELECT id, title, chapter_identifier, chapter_heading, word_count,
+           character_count, is_reserved, downloaded_at
+    FROM ecfr_chapter_wordcount
+    WHERE title = $1 AND chapter_identifier = $2
+'''
+
+WORD_COUNTS_BY_TITLE_QUERY = '''
+    SELECT id, title, chapter_identifier, chapter_heading, word_count,
+           character_count, is_reserved, downloaded_at
+    FROM ecfr_chapter_wordcount
+    WHERE title = $1
+    ORDER BY chapter_identifier
+'''
+
 # Database connection
-def get_db_connection():
-    """Get database connection"""
+async def acquire_db_connection(pool):
+    """Acquire a pooled connection, turning pool failures into an HTTP 500"""
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            cursor_factory=psycopg2.extras.RealDictCursor
-        )
-        return conn
-    except psycopg2.Error as e:
+        return await pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as e:
         logger.error(f"Database connection error: {e}")
         raise HTTPException(status_code=500, detail="Database connection failed")
 
-@app.get("/agencies", response_model=List[Agency], tags=["Agencies"], summary="Get all agencies with title information")
-async def get_agencies(slug: Optional[str] = None, name: Optional[str] = None):
+async def db_conn(request: Request):
+    """Borrow a connection from the pool for the duration of a request"""
+    pool = request.app.state.pool
+    conn = await acquire_db_connection(pool)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+@app.get("/agencies", response_model=List[Agency], tags=["Agencies"], summary="Get all agencies, optionally with CFR references and title information")
+async def get_agencies(
+    slug: Optional[str] = None,
+    name: Optional[str] = None,
+    include_refs: bool = Query(False, description="Include children and CFR references enriched with title information"),
+    conn=Depends(db_conn)
+):
     """
-    Get all agencies with optional filtering by slug and name
+    Get all agencies with optional filtering by slug and name.
+    
+    The children and cfr_references columns are only returned when include_refs=true;
+    otherwise they are null and the response carries agency metadata only.
     """
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        
-        # Build query with optional filters
-        query = '''
-            SELECT id, name, display_name, slug, children, cfr_references,
-                   created_at, updated_at
-            FROM agencies
-        '''
+        # Pick the prebuilt query for this combination of filters
+        query = AGENCIES_QUERIES[(include_refs, bool(slug), bool(name))]
         params = []
-        
-        if slug and name:
-            query += ' WHERE slug = %s AND name ILIKE %s'
-            params.extend([slug, f'%{name}%'])
-        elif slug:
-            query += ' WHERE slug = %s'
+        if slug:
             params.append(slug)
-        elif name:
-            query += ' WHERE name ILIKE %s'
+        if name:
             params.append(f'%{name}%')
         
-        query += ' ORDER BY name'
+        agencies = await conn.fetch(query, *params)
+        if not include_refs:
+            return [Agency.model_construct(**agency) for agency in agencies]
         
-        cursor.execute(query, params)
-        agencies = cursor.fetchall()
+        title_dict = await get_titles_map(conn)
         
         # Process each agency and embed title information in CFR references
         result = []
         for agency in agencies:
-            agency_data = dict(agency)
+            agency_model = Agency.model_construct(**agency)
             
             # Embed title information in CFR references
-            if agency_data['cfr_references']:
-                agency_data['cfr_references'] = enrich_cfr_refs_with_title_info(conn, agency_data['cfr_references'])
+            if agency_model.cfr_references:
+                agency_model.cfr_references = enrich_cfr_refs_with_title_info(title_dict, agency_model.cfr_references)
             
-            result.append(Agency(**agency_data))
+            result.append(agency_model)
         
         return result
         
-    except psycopg2.Error as e:
+    except asyncpg.PostgresError as e:
         logger.error(f"Database error: {e}")
         raise HTTPException(status_code=500, detail="Database error")
-    finally:
-        conn.close()
 
-def enrich_cfr_refs_with_title_info(conn, cfr_references: List[Dict]) -> List[Dict]:
+async def get_titles_map(conn) -> Dict:
+    """
+    Get title information keyed by title number, served from memory for TITLES_CACHE_TTL seconds
+    """
+    title_dict = _TITLES.get('all')
+    if title_dict is None:
+        title_info = await conn.fetch(TITLES_QUERY)
+        title_dict = {info['title_number']: info for info in title_info}
+        _TITLES['all'] = title_dict
+    return title_dict
+
+_TITLE_RE = re.compile(r'\bTitle\s+(\d+)\b')
+
+@lru_cache(maxsize=4096)
+def parse_title_from_citation(citation: str) -> Optional[int]:
+    """
+    Parse the title number from a citation like "Title 1 Chapter I"
+    """
+    match = _TITLE_RE.search(citation)
+    return int(match.group(1)) if match else None
+
+def enrich_cfr_refs_with_title_info(title_dict: Dict, cfr_references: List[Dict]) -> List[Dict]:
     """
-    Enrich CFR references with title information
+    Enrich CFR references with title information from the cached title lookup
     """
     if not cfr_references:
         return []
     
-    # Extract unique title numbers from CFR references
-    titles = set()
-    for ref in cfr_references:
-        if isinstance(ref, dict) and 'title' in ref:
-            titles.add(ref['title'])
-        elif isinstance(ref, dict) and 'citation' in ref:
-            # Parse title from citation like "Title 1 Chapter I"
-            citation = ref['citation']
-            if 'Title' in citation:
-                parts = citation.split()
-                for i, part in enumerate(parts):
-                    if part == 'Title' and i + 1 < len(parts):
-                        try:
-                            title_num = int(parts[i + 1])
-                            titles.add(title_num)
-                            break
-                        except ValueError:
-                            pass
-    
-    # Get title information for these titles
-    cursor = conn.cursor()
-    title_list = list(titles)
-    
-    if not title_list:
-        return cfr_references
-    
-    # Build query with IN clause
-    placeholders = ','.join(['%s'] * len(title_list))
-    cursor.execute(f'''
-        SELECT title_number, title_name, latest_amended_on, 
-               latest_issue_date, up_to_date_as_of
-        FROM titles
-        WHERE title_number IN ({placeholders})
-        ORDER BY title_number
-    ''', title_list)
-    
-    title_info = cursor.fetchall()
-    title_dict = {info['title_number']: dict(info) for info in title_info}
-    
-    # Enrich each CFR reference with title information
+    # Single pass: resolve each reference's title and merge in its info if known
     enriched_refs = []
     for ref in cfr_references:
-        ref_copy = dict(ref)
-        
-        # Add title information if available
-        if isinstance(ref, dict) and 'title' in ref:
-            title_num = ref['title']
-            if title_num in title_dict:
-                ref_copy.update({
-                    'title_name': title_dict[title_num]['title_name'],
-                    'latest_amended_on': title_dict[title_num]['latest_amended_on'],
-                    'latest_issue_date': title_dict[title_num]['latest_issue_date'],
-                    'up_to_date_as_of': title_dict[title_num]['up_to_date_as_of']
-                })
-        elif isinstance(ref, dict) and 'citation' in ref:
-            # Parse title from citation and add info
-            citation = ref['citation']
-            if 'Title' in citation:
-                parts = citation.split()
-                for i, part in enumerate(parts):
-                    if part == 'Title' and i + 1 < len(parts):
-                        try:
-                            title_num = int(parts[i + 1])
-                            if title_num in title_dict:
-                                ref_copy.update({
-                                    'title_name': title_dict[title_num]['title_name'],
-                                    'latest_amended_on': title_dict[title_num]['latest_amended_on'],
-                                    'latest_issue_date': title_dict[title_num]['latest_issue_date'],
-                                    'up_to_date_as_of': title_dict[title_num]['up_to_date_as_of']
-                                })
-                            break
-                        except ValueError:
-                            pass
-        
-        enriched_refs.append(ref_copy)
+        title_num = ref.get('title') or parse_title_from_citation(ref.get('citation') or '')
+        title_info = title_dict.get(title_num)
+        enriched_refs.append({**ref, **title_info} if title_info else ref)
     
     return enriched_refs
 
 @app.get("/word-count/{title}/{chapter_identifier}", response_model=WordCount, tags=["Word Counts"], summary="Get word count by title and chapter")
-async def get_word_count_by_title_and_chapter(title: int, chapter_identifier: str):
+async def get_word_count_by_title_and_chapter(title: int, chapter_identifier: str, conn=Depends(db_conn)):
     """
     Get word count for a specific title and chapter identifier
     """
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, title, chapter_identifier, chapter_heading, word_count,
-                   character_count, is_reserved, downloaded_at
-            FROM ecfr_chapter_wordcount
-            WHERE title = %s AND chapter_identifier = %s
-        ''', (title, chapter_identifier))
-        
-        word_count = cursor.fetchone()
+        word_count = await conn.fetchrow(WORD_COUNT_QUERY, title, chapter_identifier)
         
         if not word_count:
             raise HTTPException(
@@ -255,123 +340,222 @@ async def get_word_count_by_title_and_chapter(title: int, chapter_identifier: st
                 detail=f"Word count not found for title {title} and chapter {chapter_identifier}"
             )
         
-        return WordCount(**dict(word_count))
+        return WordCount.model_construct(**word_count)
         
-    except psycopg2.Error as e:
+    except asyncpg.PostgresError as e:
         logger.error(f"Database error: {e}")
         raise HTTPException(status_code=500, detail="Database error")
-    finally:
-        conn.close()
 
 @app.get("/word-counts/{title}", response_model=List[WordCount], tags=["Word Counts"], summary="Get all word counts by title")
-async def get_all_word_counts_by_title(title: int):
+async def get_all_word_counts_by_title(title: int, request: Request):
     """
-    Get all word counts for a specific title
+    Get all word counts for a specific title, streamed as a JSON array
     """
-    conn = get_db_connection()
+    # The connection outlives this function, so it is released by the stream
+    pool = request.app.state.pool
+    conn = await acquire_db_connection(pool)
+    transaction = conn.transaction(readonly=True)
+    started = False
     try:
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, title, chapter_identifier, chapter_heading, word_count,
-                   character_count, is_reserved, downloaded_at
-            FROM ecfr_chapter_wordcount
-            WHERE title = %s
-            ORDER BY chapter_identifier
-        ''', (title,))
-        
-        word_counts = cursor.fetchall()
-        return [WordCount(**dict(wc)) for wc in word_counts]
-        
-    except psycopg2.Error as e:
-        logger.error(f"Database error: {e}")
-        raise HTTPException(status_code=500, detail="Database error")
-    finally:
-        conn.close()
+        await transaction.start()
+        started = True
+        cursor = await conn.cursor(WORD_COUNTS_BY_TITLE_QUERY, title)
+    except BaseException as e:
+        # The stream never took ownership, so return the connection on any failure
+        try:
+            if started:
+                await transaction.rollback()
+        finally:
+            await pool.release(conn)
+        if isinstance(e, asyncpg.PostgresError):
+            logger.error(f"Database error: {e}")
+            raise HTTPException(status_code=500, detail="Database error")
+        raise
+    
+    return StreamingResponse(
+        stream_word_counts(pool, conn, transaction, cursor),
+        media_type="application/json"
+    )
 
-@app.post("/ai/agency-summary", response_model=AgencySummaryResponse, tags=["AI"], summary="Generate AI-powered agency summary")
-async def generate_agency_summary(request: AgencySummaryRequest):
+async def stream_word_counts(pool, conn, transaction, cursor):
     """
-    Generate an AI-powered summary for an agency based on its name, CFR references, and description
+    Encode rows from a server-side cursor into a JSON array one chunk at a time
     """
     try:
-        # Extract CFR titles and chapters for context
-        cfr_context = []
-        if request.cfr_references:
-            for ref in request.cfr_references[:10]:  # Limit to first 10 references to avoid token limits
-                title_info = f"Title {ref.get('title', 'N/A')}: {ref.get('name', 'Unknown Title')}"
-                if ref.get('chapter'):
-                    title_info += f", Chapter {ref['chapter']}"
-                cfr_context.append(title_info)
-        
-        # Create prompt for OpenAI
-        prompt = f"""
-        Generate a comprehensive summary for the U.S. government agency: {request.agency_name}
-        
-        Display Name: {request.agency_display_name or 'N/A'}
-        
-        CFR References:
-        {chr(10).join(cfr_context) if cfr_context else 'No CFR references available'}
-        
-        Description: {request.description or 'No description available'}
-        
-        Please provide:
-        1. A concise 2-3 sentence summary of the agency's role and mission
-        2. A list of 3-5 key responsibilities
-        3. A brief description of the agency's regulatory scope
-        
-        Format the response as JSON with keys: summary, key_responsibilities (array), regulatory_scope
-        """
-        
-        # Call OpenAI API
-        from openai import OpenAI
-        client = OpenAI(api_key=openai.api_key)
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are an expert on U.S. government agencies and federal regulations. Provide accurate, concise information about regulatory agencies."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=500,
-            temperature=0.7
-        )
-        
-        # Parse the response
-        content = response.choices[0].message.content
-        
-        # Try to parse as JSON, fallback to text if needed
+        yield b'['
+        separator = b''
+        while True:
+            rows = await cursor.fetch(WORD_COUNTS_CHUNK_SIZE)
+            if not rows:
+                break
+            # Strip the brackets so chunks join into a single array
+            yield separator + orjson.dumps([dict(row) for row in rows])[1:-1]
+            separator = b','
+        yield b']'
+    except asyncpg.PostgresError as e:
+        # Headers are already sent; re-raise so the server aborts the response
+        # instead of ending it cleanly with a truncated array
+        logger.error(f"Database error while streaming word counts: {e}")
+        raise
+    finally:
         try:
-            import json
-            ai_response = json.loads(content)
-            summary = ai_response.get("summary", content)
-            key_responsibilities = ai_response.get("key_responsibilities", [])
-            regulatory_scope = ai_response.get("regulatory_scope", "Regulatory scope not specified")
-        except json.JSONDecodeError:
-            # Fallback: use the raw content as summary
-            summary = content
-            key_responsibilities = ["Key responsibilities not specified"]
-            regulatory_scope = "Regulatory scope not specified"
-        
+            await transaction.rollback()
+        finally:
+            await pool.release(conn)
+
+# Prompts for agency summaries, built once at import
+SUMMARY_SYSTEM_PROMPT = "You are an expert on U.S. government agencies and federal regulations. Provide accurate, concise information about regulatory agencies."
+
+SUMMARY_PROMPT_TEMPLATE = """
+Generate a comprehensive summary for the U.S. government agency: {agency_name}
+
+Display Name: {display_name}
+
+CFR References:
+{cfr_block}
+
+Description: {description}
+
+Please provide:
+1. A concise 2-3 sentence summary of the agency's role and mission
+2. A list of 3-5 key responsibilities
+3. A brief description of the agency's regulatory scope
+
+Format the response as JSON with keys: summary, key_responsibilities (array), regulatory_scope
+"""
+
+def summary_cache_key(request: AgencySummaryRequest) -> str:
+    """
+    Hash the normalized summary request so identical payloads share a cache entry
+    """
+    payload = orjson.dumps(request.model_dump(), option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+async def summarize_agency(request: AgencySummaryRequest) -> AgencySummaryResponse:
+    """
+    Ask OpenAI for an agency summary; raises if the call or response is unusable
+    """
+    # Extract CFR titles and chapters for context
+    cfr_context = []
+    if request.cfr_references:
+        for ref in request.cfr_references[:10]:  # Limit to first 10 references to avoid token limits
+            title_info = f"Title {ref.get('title', 'N/A')}: {ref.get('name', 'Unknown Title')}"
+            if ref.get('chapter'):
+                title_info += f", Chapter {ref['chapter']}"
+            cfr_context.append(title_info)
+    
+    # Create prompt for OpenAI
+    prompt = SUMMARY_PROMPT_TEMPLATE.format(
+        agency_name=request.agency_name,
+        display_name=request.agency_display_name or 'N/A',
+        cfr_block="\n".join(cfr_context) or 'No CFR references available',
+        description=request.description or 'No description available'
+    )
+    
+    # Call OpenAI API
+    response = await app.state.openai.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=500,
+        temperature=0.7,
+        response_format={"type": "json_object"}
+    )
+    
+    # JSON mode guarantees a JSON document; anything else is an upstream fault
+    content = response.choices[0].message.content
+    try:
+        ai_response = orjson.loads(content)
         return AgencySummaryResponse(
-            summary=summary,
-            key_responsibilities=key_responsibilities,
-            regulatory_scope=regulatory_scope,
+            summary=ai_response.get("summary", content),
+            key_responsibilities=ai_response.get("key_responsibilities", []),
+            regulatory_scope=ai_response.get("regulatory_scope", "Regulatory scope not specified"),
             generated_at=datetime.now()
         )
-        
+    except (orjson.JSONDecodeError, TypeError, AttributeError, ValidationError) as e:
+        logger.error(f"Malformed AI summary response: {e}")
+        raise HTTPException(status_code=502, detail="AI service returned a malformed summary")
+
+def fallback_agency_summary(request: AgencySummaryRequest) -> AgencySummaryResponse:
+    """
+    Generic summary returned when OpenAI is unavailable
+    """
+    return AgencySummaryResponse(
+        summary=f"{request.agency_name} is a U.S. government agency responsible for regulatory oversight and compliance enforcement.",
+        key_responsibilities=[
+            "Regulatory compliance",
+            "Policy enforcement",
+            "Industry oversight"
+        ],
+        regulatory_scope="Federal regulatory jurisdiction as defined by CFR references",
+        generated_at=datetime.now()
+    )
+
+async def generate_and_cache_summary(key: str, request: AgencySummaryRequest) -> AgencySummaryResponse:
+    """
+    Generate a summary and cache it, falling back to a generic summary on failure
+    """
+    try:
+        summary = await summarize_agency(request)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error generating AI summary: {e}")
-        # Return a fallback response instead of failing
-        return AgencySummaryResponse(
-            summary=f"{request.agency_name} is a U.S. government agency responsible for regulatory oversight and compliance enforcement.",
-            key_responsibilities=[
-                "Regulatory compliance",
-                "Policy enforcement",
-                "Industry oversight"
-            ],
-            regulatory_scope="Federal regulatory jurisdiction as defined by CFR references",
-            generated_at=datetime.now()
+        # Return a fallback response instead of failing; don't cache it
+        return fallback_agency_summary(request)
+    
+    _SUMMARIES[key] = summary
+    return summary
+
+async def get_agency_summary(request: AgencySummaryRequest) -> AgencySummaryResponse:
+    """
+    Return a cached summary or generate one, falling back to a generic summary on failure
+    """
+    key = summary_cache_key(request)
+    cached = _SUMMARIES.get(key)
+    if cached is not None:
+        return cached
+    
+    # Concurrent misses for the same payload share one in-flight call and its outcome,
+    # including the fallback or a 502
+    task = _SUMMARY_TASKS.get(key)
+    if task is None:
+        task = asyncio.ensure_future(generate_and_cache_summary(key, request))
+        _SUMMARY_TASKS[key] = task
+        task.add_done_callback(lambda _: _SUMMARY_TASKS.pop(key, None))
+    # Shielded so one disconnecting client doesn't cancel the call for the others
+    return await asyncio.shield(task)
+
+@app.post("/ai/agency-summary", response_model=AgencySummaryResponse, tags=["AI"], summary="Generate AI-powered agency summary")
+async def generate_agency_summary(request: AgencySummaryRequest):
+    """
+    Generate an AI-powered summary for an agency based on its name, CFR references, and description
+    """
+    return await get_agency_summary(request)
+
+@app.post("/ai/agency-summaries", response_model=List[AgencySummaryResponse], tags=["AI"], summary="Generate AI-powered summaries for several agencies")
+async def generate_agency_summaries(requests: List[AgencySummaryRequest], http_request: Request):
+    """
+    Generate summaries for a batch of agencies concurrently, returned in request order
+    """
+    if len(requests) > SUMMARY_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=422,
+            detail=f"At most {SUMMARY_BATCH_MAX_SIZE} agencies can be summarized per request"
         )
+    semaphore = http_request.app.state.summary_semaphore
+    
+    async def summarize_one(request: AgencySummaryRequest) -> AgencySummaryResponse:
+        async with semaphore:
+            return await get_agency_summary(request)
+    
+    results = await asyncio.gather(*(summarize_one(request) for request in requests), return_exceptions=True)
+    return [
+        fallback_agency_summary(request) if isinstance(result, Exception) else result
+        for request, result in zip(requests, results)
+    ]
 
 if __name__ == "__main__":
     import uvicorn
@@ -8,26 +8,41 @@ Fields collected for agencies: name, display_name, slug, children (JSONB), cfr_r
 Fields collected for titles: title_number, title_name, title_abbreviation, chapter_count, is_reserved
 """
 
+import csv
+import io
+from collections import deque
 import psycopg2
 import psycopg2.extras
+from psycopg2.extras import Json, execute_values
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import logging.handlers
+import orjson
 from typing import List, Dict, Optional
-from datetime import datetime
-import json
 import os
 
 # Configure logging
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+file_handler = logging.FileHandler('local_postgres_agencies_ingestion.log')
+file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     handlers=[
-        logging.FileHandler('local_postgres_agencies_ingestion.log'),
+        # Buffer file writes; errors and interpreter exit flush the buffer
+        logging.handlers.MemoryHandler(capacity=200, flushLevel=logging.ERROR, target=file_handler),
         logging.StreamHandler()
     ]
 )
 logger = logging.getLogger(__name__)
 
+class OrjsonJson(Json):
+    """Json adapter that serializes with orjson instead of the stdlib json module"""
+    def dumps(self, obj):
+        return orjson.dumps(obj).decode()
+
 class LocalPostgresAgenciesIngestion:
     def __init__(self):
         """Initialize the agencies ingestion system"""
@@ -44,13 +59,19 @@ class LocalPostgresAgenciesIngestion:
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'eCFR-Local-Postgres-Ingestion/1.0',
-            'Accept': 'application/json'
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate'
         })
+        # Retry transient failures with backoff instead of failing the whole run
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                        raise_on_status=False)
+        self.session.mount('https://', HTTPAdapter(max_retries=retries))
         self.db_conn = None
+        self.cursor = None
         self.setup_database()
     
     def setup_database(self):
-        """Setup local PostgreSQL database"""
+        """Connect to the local PostgreSQL database and make sure the tables exist"""
         try:
             # Connect to PostgreSQL
             self.db_conn = psycopg2.connect(
@@ -63,9 +84,19 @@ class LocalPostgresAgenciesIngestion:
             )
             self.db_conn.autocommit = True
             
-            # Create cursor with dict-like access
-            cursor = self.db_conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            # One cursor with dict-like access, reused for the whole ingestion run
+            self.cursor = self.db_conn.cursor()
+            self.create_tables()
+            logger.info("Local PostgreSQL database setup completed")
             
+        except psycopg2.Error as e:
+            logger.error(f"Database setup error: {e}")
+            raise
+    
+    def create_tables(self):
+        """Create the agencies and titles tables; indexes are built after loading"""
+        cursor = self.cursor
+        try:
             # Create agencies table
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS agencies (
@@ -75,17 +106,22 @@ class LocalPostgresAgenciesIngestion:
                     slug TEXT UNIQUE,
                     children JSONB,
                     cfr_references JSONB,
-                    raw_data JSONB,
+                    raw_data JSON,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
             
-            # Create agencies table indexes for better performance
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_agencies_slug ON agencies(slug)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_agencies_name ON agencies(name)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_agencies_children_gin ON agencies USING GIN(children)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_agencies_cfr_refs_gin ON agencies USING GIN(cfr_references)')
+            # raw_data is a write-only archive: plain JSON skips jsonb parsing on insert.
+            # Convert tables created before the column type changed
+            cursor.execute('''
+                SELECT data_type FROM information_schema.columns
+                WHERE table_schema = current_schema()
+                  AND table_name = 'agencies' AND column_name = 'raw_data'
+            ''')
+            if cursor.fetchone()[0] == 'jsonb':
+                cursor.execute('ALTER TABLE agencies ALTER COLUMN raw_data TYPE JSON USING raw_data::json')
+            
             # Create titles table
             cursor.execute('''
             CREATE TABLE IF NOT EXISTS titles (
@@ -102,16 +138,39 @@ class LocalPostgresAgenciesIngestion:
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
             ''')
+        except psycopg2.Error as e:
+            logger.error(f"Table creation error: {e}")
+            raise
+    
+    def create_indexes(self):
+        """Create secondary indexes once the data is loaded, so a fresh load builds them in bulk"""
+        cursor = self.cursor
+        try:
+            # Create agencies table indexes for better performance
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_agencies_slug ON agencies(slug)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_agencies_name ON agencies(name)')
+            # Nothing queries children by containment, and cfr_references only needs @>,
+            # which the smaller jsonb_path_ops GIN supports
+            cursor.execute('DROP INDEX IF EXISTS idx_agencies_children_gin')
+            cursor.execute('DROP INDEX IF EXISTS idx_agencies_cfr_refs_gin')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_agencies_cfr_refs_path_gin ON agencies USING GIN(cfr_references jsonb_path_ops)')
+            
             # Create titles table indexes
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_titles_number ON titles(title_number)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_titles_name ON titles(title_name)')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_titles_reserved ON titles(is_reserved)')
-            self.db_conn.commit()
-            logger.info("Local PostgreSQL database setup completed")
-            
+            logger.info("Indexes created")
         except psycopg2.Error as e:
-            logger.error(f"Database setup error: {e}")
+            logger.error(f"Index creation error: {e}")
             raise
+        
+        # Trigram index so the API's name ILIKE '%...%' filter can use an index. It is optional:
+        # pg_trgm ships with contrib and needs CREATE rights, and without it the filter just scans
+        try:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_agencies_name_trgm ON agencies USING GIN(name gin_trgm_ops)')
+        except psycopg2.Error as e:
+            logger.warning(f"Skipping trigram index on agencies.name, pg_trgm is unavailable: {e}")
     
     def fetch_agencies(self) -> List[Dict]:
         """Fetch agencies from eCFR Admin API"""
@@ -121,12 +180,12 @@ class LocalPostgresAgenciesIngestion:
             response.raise_for_status()
             
             data = response.json()
-            logger.info(f"API response type: {type(data)}")
+            logger.debug(f"API response type: {type(data)}")
             
             # Handle different response formats
             agencies = []
             if isinstance(data, dict):
-                logger.info(f"Response keys: {list(data.keys())}")
+                logger.debug(f"Response keys: {list(data.keys())}")
                 if 'agencies' in data and isinstance(data['agencies'], list):
                     agencies = data['agencies']
                 elif 'data' in data and isinstance(data['data'], list):
@@ -156,100 +215,101 @@ class LocalPostgresAgenciesIngestion:
         # Common locations for CFR references
         ref_keys = ['cfr_references', 'cfr_refs', 'references', 'citations']
         
-        for key in ref_keys:
-            if key in agency_data:
-                refs = agency_data[key]
+        # Walk the agency and its children depth-first with an explicit stack
+        stack = deque([agency_data])
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, dict):
+                continue
+            
+            for key in ref_keys:
+                refs = node.get(key)
                 if isinstance(refs, list):
                     cfr_refs.extend(refs)
                 elif isinstance(refs, dict):
                     cfr_refs.append(refs)
-        
-        # Also check in children recursively
-        if 'children' in agency_data and isinstance(agency_data['children'], list):
-            for child in agency_data['children']:
-                child_refs = self.extract_cfr_references(child)
-                cfr_refs.extend(child_refs)
+            
+            children = node.get('children')
+            if isinstance(children, list):
+                # Reversed so children pop in order, keeping the recursive version's ordering
+                stack.extend(reversed(children))
         
         return cfr_refs
     
-    def save_agency(self, agency_data: Dict) -> int:
-        """Save agency to PostgreSQL database"""
-        try:
-            cursor = self.db_conn.cursor()
-            
-            # Extract required fields
-            name = agency_data.get('name', '')
-            display_name = agency_data.get('display_name', agency_data.get('displayName', name))
-            slug = agency_data.get('slug', agency_data.get('short_name', ''))
-            
-            # Prepare children as JSONB
-            children = agency_data.get('children', [])
-            if isinstance(children, list):
-                children_json = json.dumps(children) if children else None
-            else:
-                children_json = json.dumps([children]) if children else None
-            
-            # Extract CFR references
-            cfr_refs = self.extract_cfr_references(agency_data)
-            cfr_refs_json = json.dumps(cfr_refs) if cfr_refs else None
-            
-            # Store raw data
-            raw_data_json = json.dumps(agency_data)
-            
-            # Check if agency already exists
-            cursor.execute('SELECT id FROM agencies WHERE slug = %s', (slug,))
-            existing = cursor.fetchone()
-            logger.info(f" Agency slug: {slug}")
-            if existing:
-                # Update existing agency
-                cursor.execute('''
-                    UPDATE agencies 
-                    SET name = %s, display_name = %s, children = %s,
-                        cfr_references = %s, raw_data = %s, updated_at = %s
-                    WHERE slug = %s
-                ''', (name, display_name, children_json, cfr_refs_json, 
-                      raw_data_json, datetime.now(), slug))
-                agency_id = existing['id']
-                logger.info(f"Updated agency: {name} (ID: {agency_id})")
-                return agency_id, 'updated'
-            else:
-                # Insert new agency
-                cursor.execute('''
-                    INSERT INTO agencies 
-                    (name, display_name, slug, children, cfr_references, raw_data)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    RETURNING id
-                ''', (name, display_name, slug, children_json, 
-                      cfr_refs_json, raw_data_json))
-                
-                result = cursor.fetchone()
-                agency_id = result['id']
-                logger.info(f"Inserted agency: {name} (ID: {agency_id})")
-                return agency_id, 'inserted'
-            
-        except Exception as e:
-            logger.error(f"Error saving agency: {e}")
-            logger.error(f"Agency data: {agency_data}")
-            raise
+    def build_agency_row(self, agency_data: Dict) -> tuple:
+        """Build the agencies table row for one agency"""
+        # Extract required fields
+        name = agency_data.get('name', '')
+        display_name = agency_data.get('display_name', agency_data.get('displayName', name))
+        slug = agency_data.get('slug', agency_data.get('short_name', ''))
+        
+        # Prepare children as JSONB
+        children = agency_data.get('children', [])
+        if isinstance(children, list):
+            children_json = OrjsonJson(children) if children else None
+        else:
+            children_json = OrjsonJson([children]) if children else None
+        
+        # Extract CFR references
+        cfr_refs = self.extract_cfr_references(agency_data)
+        cfr_refs_json = OrjsonJson(cfr_refs) if cfr_refs else None
+        
+        # Store raw data
+        raw_data_json = OrjsonJson(agency_data)
+        
+        return (name, display_name, slug, children_json, cfr_refs_json, raw_data_json)
     
     def process_agencies(self, agencies: List[Dict]):
-        """Process and save all agencies"""
+        """Process and save all agencies in a single batched upsert"""
         logger.info(f"Processing {len(agencies)} agencies...")
         
-        saved_count = 0
+        # Key rows by slug: one upsert statement cannot touch the same row twice
+        rows = {}
         for agency in agencies:
             try:
-                self.save_agency(agency)
-                saved_count += 1
+                row = self.build_agency_row(agency)
+                rows[row[2]] = row
             except Exception as e:
-                logger.error(f"Failed to save agency: {e}")
+                logger.error(f"Failed to prepare agency: {e}")
+                logger.error(f"Agency data: {agency}")
                 continue
         
-        logger.info(f"Successfully saved {saved_count} agencies")
+        if not rows:
+            logger.warning("No agencies to save")
+            return
+        
+        cursor = self.cursor
+        try:
+            # execute_values sends one statement per page; keep the pages all-or-nothing
+            cursor.execute('BEGIN')
+            # xmax = 0 only for freshly inserted rows, which lets us report inserts vs updates
+            results = execute_values(cursor, '''
+                INSERT INTO agencies
+                (name, display_name, slug, children, cfr_references, raw_data)
+                VALUES %s
+                ON CONFLICT (slug) DO UPDATE
+                SET name = EXCLUDED.name, display_name = EXCLUDED.display_name,
+                    children = EXCLUDED.children, cfr_references = EXCLUDED.cfr_references,
+                    raw_data = EXCLUDED.raw_data, updated_at = NOW()
+                RETURNING (xmax = 0) AS inserted
+            ''', list(rows.values()), page_size=500, fetch=True)
+            cursor.execute('COMMIT')
+        except Exception as e:
+            # Covers adaptation errors (e.g. unserializable JSON) as well as database errors
+            logger.error(f"Failed to save agencies: {e}")
+            if not self.db_conn.closed:
+                cursor.execute('ROLLBACK')
+            raise
+        
+        cursor.execute('ANALYZE agencies')
+        
+        inserted_count = sum(1 for result in results if result[0])
+        logger.info(f"Successfully saved {len(results)} agencies "
+                    f"({inserted_count} inserted, {len(results) - inserted_count} updated)")
     
     def get_agency_stats(self) -> Dict:
         """Get statistics about ingested agencies"""
-        cursor = self.db_conn.cursor()
+        cursor = self.cursor
         cursor.execute('''
             SELECT 
                 COUNT(*) as total_agencies,
@@ -264,7 +324,7 @@ class LocalPostgresAgenciesIngestion:
     
     def query_agencies(self, limit: int = 10, offset: int = 0) -> List[Dict]:
         """Query agencies from database"""
-        cursor = self.db_conn.cursor()
+        cursor = self.cursor
         cursor.execute('''
             SELECT name, display_name, slug, 
                    children as children,
@@ -284,11 +344,11 @@ class LocalPostgresAgenciesIngestion:
             response = self.session.get(self.titles_api_url, timeout=30)
             response.raise_for_status()
             data = response.json()
-            logger.info(f"API response type: {type(data)}")
+            logger.debug(f"API response type: {type(data)}")
             # Handle different response formats
             titles = []
             if isinstance(data, dict):
-                logger.info(f"Response keys: {list(data.keys())}")
+                logger.debug(f"Response keys: {list(data.keys())}")
                 if 'titles' in data and isinstance(data['titles'], list):
                     titles = data['titles']
                 elif 'data' in data and isinstance(data['data'], list):
@@ -312,107 +372,106 @@ class LocalPostgresAgenciesIngestion:
             logger.error(f"Error fetching titles: {e}")
             raise
     
-    def get_chapter_count(self, title_number):
-        """Get chapter count from the ecfr_chapter_wordcount table"""
-        try:
-            cursor = self.db_conn.cursor()
-            cursor.execute(
-                "SELECT COUNT(*) FROM ecfr_chapter_wordcount WHERE title = %s",
-                (title_number,)
-            )
-            return cursor.fetchone()[0]
-        except Exception as e:
-            logger.error(f"Error getting chapter count: {e}")
-            raise
-    def get_chapter_count(self, title_number):
-        """Get chapter count from the ecfr_chapter_wordcount table"""
-        try:
-            cursor = self.db_conn.cursor()
-            cursor.execute(
-                "SELECT COUNT(*) FROM ecfr_chapter_wordcount WHERE title = %s",
-                (title_number,)
-            )
-            return cursor.fetchone()[0]
-        except Exception as e:
-            logger.error(f"Error getting chapter count: {e}")
-            raise
-    
-    def save_title(self, title_data: Dict) -> int:
-        """Save title to PostgreSQL database"""
-        try:
-            cursor = self.db_conn.cursor()
-            
-            # Extract title information
-            title_number = title_data.get('number')
-            title_name = title_data.get('name', '')
-            
-            # Check if title is reserved
-            is_reserved = title_data.get('reserved', False)
-            
-            # Extract date fields
-            latest_amended_on = title_data.get('latest_amended_on')
-            latest_issue_date = title_data.get('latest_issue_date')
-            up_to_date_as_of = title_data.get('up_to_date_as_of')
-            
-            # Get chapter count from existing data if available
-            chapter_count = self.get_chapter_count(title_number)
-            
-            # Check if title already exists
-            cursor.execute('SELECT id FROM titles WHERE title_number = %s', (title_number,))
-            existing = cursor.fetchone()
-            
-            if existing:
-                # Update existing title
-                cursor.execute('''
-                    UPDATE titles 
-                    SET title_name = %s, chapter_count = %s,
-                        is_reserved = %s, latest_amended_on = %s,
-                        latest_issue_date = %s, up_to_date_as_of = %s,
-                        updated_at = %s
-                    WHERE title_number = %s
-                ''', (title_name, chapter_count, is_reserved, latest_amended_on,
-                      latest_issue_date, up_to_date_as_of, datetime.now(), title_number))
-                title_id = existing['id']
-                logger.info(f"Updated title: {title_name} (ID: {title_id})")
-                return title_id, 'updated'
-            else:
-                # Insert new title
-                cursor.execute('''
-                    INSERT INTO titles (title_number, title_name, chapter_count, is_reserved,
-                                       latest_amended_on, latest_issue_date, up_to_date_as_of)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id
-                ''', (title_number, title_name, chapter_count, is_reserved,
-                      latest_amended_on, latest_issue_date, up_to_date_as_of))
-                
-                result = cursor.fetchone()
-                title_id = result['id']
-                logger.info(f"Inserted title: {title_name} (ID: {title_id})")
-                return title_id, 'inserted'
-            
-        except Exception as e:
-            logger.error(f"Error saving title: {e}")
-            logger.error(f"Title data: {title_data}")
-            raise
+    def build_title_row(self, title_data: Dict) -> tuple:
+        """Build the titles table row for one title"""
+        # Extract title information
+        title_number = title_data.get('number')
+        if title_number is None:
+            raise ValueError("Title has no number")
+        title_name = title_data.get('name', '')
+        
+        # Check if title is reserved
+        is_reserved = title_data.get('reserved', False)
+        
+        # Extract date fields
+        latest_amended_on = title_data.get('latest_amended_on')
+        latest_issue_date = title_data.get('latest_issue_date')
+        up_to_date_as_of = title_data.get('up_to_date_as_of')
+        
+        return (title_number, title_name, is_reserved,
+                latest_amended_on, latest_issue_date, up_to_date_as_of)
     
     def process_titles(self, titles: List[Dict]):
-        """Process and save all titles"""
+        """Process and save all titles, streaming them through COPY into a staging table"""
         logger.info(f"Processing {len(titles)} titles...")
         
-        saved_count = 0
+        rows = []
         for title in titles:
             try:
-                self.save_title(title)
-                saved_count += 1
+                rows.append(self.build_title_row(title))
             except Exception as e:
-                logger.error(f"Failed to save title: {e}")
+                logger.error(f"Failed to prepare title: {e}")
+                logger.error(f"Title data: {title}")
                 continue
         
-        logger.info(f"Successfully saved {saved_count} titles")
+        if not rows:
+            logger.warning("No titles to save")
+            return
+        
+        # Serialize as CSV; None becomes an unquoted empty field, which COPY reads as NULL
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        
+        try:
+            cursor = self.cursor
+            cursor.execute('DROP TABLE IF EXISTS titles_staging')
+            cursor.execute('''
+                CREATE TEMP TABLE titles_staging (
+                    title_number INTEGER,
+                    title_name TEXT,
+                    is_reserved BOOLEAN,
+                    latest_amended_on DATE,
+                    latest_issue_date DATE,
+                    up_to_date_as_of DATE
+                )
+            ''')
+            cursor.copy_expert('''
+                COPY titles_staging (title_number, title_name, is_reserved,
+                                     latest_amended_on, latest_issue_date, up_to_date_as_of)
+                FROM STDIN WITH (FORMAT CSV, FORCE_NOT_NULL (title_name))
+            ''', buffer)
+            
+            # Upsert from staging; DISTINCT ON keeps one row per title so no row is updated twice.
+            # Chapter counts come from one aggregate over the word count table
+            cursor.execute('''
+                INSERT INTO titles (title_number, title_name, chapter_count, is_reserved,
+                                    latest_amended_on, latest_issue_date, up_to_date_as_of)
+                SELECT DISTINCT ON (s.title_number)
+                       s.title_number, s.title_name, COALESCE(c.chapter_count, 0), s.is_reserved,
+                       s.latest_amended_on, s.latest_issue_date, s.up_to_date_as_of
+                FROM titles_staging s
+                LEFT JOIN (
+                    SELECT title, COUNT(*) AS chapter_count
+                    FROM ecfr_chapter_wordcount
+                    GROUP BY title
+                ) c ON c.title = s.title_number
+                ORDER BY s.title_number
+                ON CONFLICT (title_number) DO UPDATE
+                SET title_name = EXCLUDED.title_name, chapter_count = EXCLUDED.chapter_count,
+                    is_reserved = EXCLUDED.is_reserved, latest_amended_on = EXCLUDED.latest_amended_on,
+                    latest_issue_date = EXCLUDED.latest_issue_date,
+                    up_to_date_as_of = EXCLUDED.up_to_date_as_of, updated_at = NOW()
+                RETURNING (xmax = 0) AS inserted
+            ''')
+            results = cursor.fetchall()
+            cursor.execute('DROP TABLE titles_staging')
+        except Exception as e:
+            # One bad row fails the whole COPY, so fail the run rather than report success
+            logger.error(f"Failed to save titles: {e}")
+            if not self.db_conn.closed:
+                cursor.execute('DROP TABLE IF EXISTS titles_staging')
+            raise
+        
+        cursor.execute('ANALYZE titles')
+        
+        inserted_count = sum(1 for result in results if result[0])
+        logger.info(f"Successfully saved {len(results)} titles "
+                    f"({inserted_count} inserted, {len(results) - inserted_count} updated)")
     
     def get_titles_stats(self) -> Dict:
         """Get statistics about ingested titles"""
-        cursor = self.db_conn.cursor()
+        cursor = self.cursor
         cursor.execute('''
             SELECT 
                 COUNT(*) as total_titles,
@@ -463,7 +522,7 @@ class LocalPostgresAgenciesIngestion:
                 logger.info(f"Titles ingestion completed. Stats: {stats}")
                 
                 # Show sample titles
-                cursor = self.db_conn.cursor()
+                cursor = self.cursor
                 cursor.execute('''
                     SELECT title_number, title_name, chapter_count, is_reserved
                     FROM titles
@@ -474,6 +533,9 @@ class LocalPostgresAgenciesIngestion:
                 logger.info("\nSample titles:")
                 for title in sample_titles:
                     logger.info(f"- Title {title['title_number']}: {title['title_name']} ({title['chapter_count']} chapters)")
+            
+            # Build indexes after the bulk load rather than maintaining them row by row
+            self.create_indexes()
             logger.info("\n🎉 Complete ingestion finished successfully!")
             
         except Exception as e:
@@ -1,8 +1,12 @@
+import io
+import struct
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import psycopg2
-import xml.etree.ElementTree as ET
-import re
-import time
+import lxml.etree as LET
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 # =======================
@@ -10,7 +14,7 @@ from datetime import datetime
 # =======================
 BASE_URL = "https://www.ecfr.gov/api/versioner/v1/full/2025-08-30/title-{}.xml"
 TITLES = range(1, 51)   # Titles 1–50
-REQUEST_DELAY = 1.2      # Pause between API calls
+MAX_WORKERS = 8          # Concurrent title downloads
 
 PG_CONN = {
     "host": "localhost",
@@ -23,7 +27,13 @@ PG_CONN = {
 # =======================
 # POSTGRES: CREATE TABLE
 # =======================
-CREATE_TABLE_SQL = """
+# Reserved chapters are derived from the heading by Postgres, so the loader never sends the flag
+IS_RESERVED_COLUMN_SQL = (
+    "is_reserved BOOLEAN GENERATED ALWAYS AS "
+    "(COALESCE(position('[Reserved]' in chapter_heading) > 0, FALSE)) STORED"
+)
+
+CREATE_TABLE_SQL = f"""
 CREATE TABLE IF NOT EXISTS ecfr_chapter_wordcount (
     id SERIAL PRIMARY KEY,
     title INTEGER NOT NULL,
@@ -31,123 +41,169 @@ CREATE TABLE IF NOT EXISTS ecfr_chapter_wordcount (
     chapter_heading TEXT,
     word_count INTEGER NOT NULL,
     character_count INTEGER,
-    is_reserved BOOLEAN DEFAULT FALSE,
+    {IS_RESERVED_COLUMN_SQL},
     downloaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 """
 
-INSERT_SQL = """
-INSERT INTO ecfr_chapter_wordcount (title, chapter_identifier, chapter_heading, word_count, character_count, is_reserved)
-VALUES (%s, %s, %s, %s, %s, %s)
-RETURNING id;
+IS_RESERVED_GENERATED_SQL = """
+SELECT is_generated FROM information_schema.columns
+WHERE table_schema = current_schema()
+  AND table_name = 'ecfr_chapter_wordcount' AND column_name = 'is_reserved'
+"""
+
+# Built after the load; serves the API's lookups by title and by (title, chapter)
+CREATE_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_ecfr_chapter_wordcount_title_chapter
+    ON ecfr_chapter_wordcount (title, chapter_identifier);
+"""
+
+# A title's chapters are replaced on every load, so re-running doesn't duplicate rows
+DELETE_TITLE_SQL = "DELETE FROM ecfr_chapter_wordcount WHERE title = %s"
+
+# Binary COPY: integers go over the wire as int4 instead of text the server has to parse
+COPY_SQL = """
+COPY ecfr_chapter_wordcount (title, chapter_identifier, chapter_heading, word_count, character_count)
+FROM STDIN WITH (FORMAT BINARY)
 """
 
+# Binary COPY framing: signature, flags and header extension length, then rows, then -1
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+COPY_ROW_HEAD = struct.Struct("!hii")    # field count, then title as a length-prefixed int4
+COPY_TEXT_LEN = struct.Struct("!i")      # byte length before each text field
+COPY_ROW_TAIL = struct.Struct("!iiii")   # word_count and character_count as length-prefixed int4
+
 
 # =======================
 # HELPERS
 # =======================
-def setup_postgres():
-    conn = psycopg2.connect(**PG_CONN)
-    cur = conn.cursor()
+_thread_local = threading.local()
+
+
+def get_session() -> requests.Session:
+    """Return this thread's HTTP session so each download worker keeps its connections alive."""
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        # Retry transient failures with backoff; a final bad status is still reported by the caller
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                        raise_on_status=False)
+        session.mount("https://", HTTPAdapter(max_retries=retries))
+        _thread_local.session = session
+    return session
+
+
+def setup_postgres(cur):
     cur.execute(CREATE_TABLE_SQL)
-    conn.commit()
-    cur.close()
-    conn.close()
 
+    # Tables created before is_reserved was generated still have a plain column; swap it out
+    cur.execute(IS_RESERVED_GENERATED_SQL)
+    if cur.fetchone()[0] == "NEVER":
+        cur.execute("ALTER TABLE ecfr_chapter_wordcount DROP COLUMN is_reserved")
+        cur.execute(f"ALTER TABLE ecfr_chapter_wordcount ADD COLUMN {IS_RESERVED_COLUMN_SQL}")
 
-def fetch_title_xml(title_number: int) -> str:
+
+def fetch_title_xml(title_number: int) -> requests.Response:
+    """Open a streaming download of a title; read the XML from resp.raw."""
     url = BASE_URL.format(title_number)
     print(f"📥 Downloading Title {title_number} from {url}")
 
-    resp = requests.get(url, headers={"accept": "application/xml"}, timeout=60)
+    resp = get_session().get(url, headers={"accept": "application/xml"}, timeout=60, stream=True)
     if resp.status_code != 200:
+        resp.close()
         raise RuntimeError(f"Failed to fetch Title {title_number}, HTTP {resp.status_code}")
 
-    return resp.text
-
+    # Let urllib3 undo any Content-Encoding so the parser sees plain XML
+    resp.raw.decode_content = True
+    return resp
 
-def clean_text(xml_content: str) -> str:
-    """Strip XML tags and return plain text."""
-    # remove tags
-    text = re.sub(r"<[^>]+>", " ", xml_content)
 
-    # normalize whitespace
-    text = re.sub(r"\s+", " ", text).strip()
+def word_count(texts) -> int:
+    """Return number of words across an element's text fragments."""
+    # itertext() fragments are raw, not whitespace-normalized (tails like " of the", newlines),
+    # so counting spaces would over/under count; split() per fragment stays exact and the
+    # lists it builds are only one fragment long
+    return sum(len(text.split()) for text in texts)
 
-    return text
 
-
-def word_count(text: str) -> int:
-    """Return number of words in a text."""
-    if not text:
-        return 0
-    return len(text.split())
-
-
-def parse_chapters_for_wordcount(xml_text: str):
+def parse_chapters_for_wordcount(xml_stream):
     """
-    Parse XML and yield:
+    Parse XML incrementally from a file-like stream and yield:
     (chapter_label, chapter_heading, word_count_int)
+
+    Each chapter is freed once counted, so memory stays at about one chapter.
     """
-    root = ET.fromstring(xml_text)
+    found_title = False
     
-    # Find the title element first
-    title_elem = root.find('.//DIV1[@TYPE="TITLE"]')
-    if title_elem is None:
-        print("Warning: Could not find TITLE element")
-        return
-    
-    # Look for chapters (DIV3 with TYPE="CHAPTER") within the title
-    for chapter in title_elem.iter():
-        if chapter.tag.endswith("DIV3") and chapter.attrib.get("TYPE") == "CHAPTER":
+    # Only DIV1 (title) and DIV3 (chapter) ends are reported; comments and PIs are not chapter text
+    events = LET.iterparse(
+        xml_stream, events=("end",), tag=("{*}DIV1", "{*}DIV3"),
+        remove_comments=True, remove_pis=True, huge_tree=True
+    )
+    for _, elem in events:
+        if LET.QName(elem).localname == "DIV1":
+            if elem.get("TYPE") == "TITLE":
+                found_title = True
+            continue
+        
+        # Look for chapters (DIV3 with TYPE="CHAPTER") within the title
+        in_title = any(div.get("TYPE") == "TITLE" for div in elem.iterancestors("{*}DIV1"))
+        if in_title and elem.get("TYPE") == "CHAPTER":
             # Get chapter identifier (N attribute)
-            chapter_label = chapter.attrib.get("N", "")
+            chapter_label = elem.get("N", "")
             
             # Get chapter heading
-            heading_el = chapter.find("HEAD")
+            heading_el = elem.find("HEAD")
             chapter_heading = heading_el.text.strip() if heading_el is not None else ""
             
-            # Extract all text from this chapter
-            def extract_text(element):
-                text = ""
-                if element.text:
-                    text += element.text + " "
-                for child in element:
-                    text += extract_text(child)
-                    if child.tail:
-                        text += child.tail + " "
-                return text
-            
-            chapter_text = extract_text(chapter)
-            # Clean and count words
-            plain_text = clean_text(chapter_text)
-            wc = word_count(plain_text)
+            # Count words straight off the tree; fragment boundaries are word breaks
+            wc = word_count(elem.itertext())
             
             yield (chapter_label, chapter_heading, wc)
+        
+        # Drop the finished DIV3 and everything parsed before it
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    
+    if not found_title:
+        print("Warning: Could not find TITLE element")
 
 
-def insert_rows(title_number: int, rows):
-    conn = psycopg2.connect(**PG_CONN)
-    cur = conn.cursor()
+def download_title_chapters(title_number: int):
+    """Download and parse one title on a worker thread; return its chapter rows."""
+    with fetch_title_xml(title_number) as resp:
+        return list(parse_chapters_for_wordcount(resp.raw))
+
+
+def insert_rows(title_number: int, rows, cur):
+    # Build the whole title in binary COPY format in memory and load it with a single COPY
+    buffer = io.BytesIO()
+    buffer.write(COPY_HEADER)
 
     inserted = 0
 
     for chapter_label, chapter_heading, wc in rows:
-        # Check if chapter is reserved
-        is_reserved = "[Reserved]" in chapter_heading if chapter_heading else False
-        
-        # Calculate character count
+        # Calculate character count; is_reserved is generated from the heading by Postgres
         char_count = len(chapter_heading) if chapter_heading else 0
         
-        cur.execute(
-            INSERT_SQL,
-            (title_number, chapter_label, chapter_heading, wc, char_count, is_reserved)
-        )
+        # Empty labels/headings are sent as zero-length text, so they stay '' rather than NULL
+        label = chapter_label.encode("utf-8")
+        heading = chapter_heading.encode("utf-8")
+        buffer.write(COPY_ROW_HEAD.pack(5, 4, title_number))
+        buffer.write(COPY_TEXT_LEN.pack(len(label)))
+        buffer.write(label)
+        buffer.write(COPY_TEXT_LEN.pack(len(heading)))
+        buffer.write(heading)
+        buffer.write(COPY_ROW_TAIL.pack(4, wc, 4, char_count))
         inserted += 1
 
-    conn.commit()
-    cur.close()
-    conn.close()
+    buffer.write(COPY_TRAILER)
+    buffer.seek(0)
+    cur.execute(DELETE_TITLE_SQL, (title_number,))
+    cur.copy_expert(COPY_SQL, buffer)
 
     return inserted
 
@@ -156,24 +212,48 @@ def insert_rows(title_number: int, rows):
 # MAIN
 # =======================
 def main():
-    print("🔧 Setting up PostgreSQL…")
-    setup_postgres()
-
-    for title in TITLES:
-        try:
-            xml_text = fetch_title_xml(title)
-            chapters = list(parse_chapters_for_wordcount(xml_text))
-            count = insert_rows(title, chapters)
-
-            print(f"✅ Title {title}: inserted wordcount for {count} chapters")
-
-        except Exception as e:
-            print(f"❌ Error processing Title {title}: {e}")
-
-        time.sleep(REQUEST_DELAY)
-
-    print("🎉 All titles processed.")
+    # One connection for the whole run; all titles load in a single transaction
+    conn = psycopg2.connect(**PG_CONN)
+    conn.autocommit = False
+    cur = conn.cursor()
 
+    try:
+        print("🔧 Setting up PostgreSQL…")
+        setup_postgres(cur)
+        conn.commit()
+
+        # The run is committed once; a commit lost to a crash just means re-running the load,
+        # so don't wait on the WAL flush for it
+        cur.execute("SET LOCAL synchronous_commit = off")
+
+        # Downloads and parsing run on worker threads; inserts stay on this thread
+        # because a psycopg2 connection must not be shared between threads
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = {executor.submit(download_title_chapters, title): title for title in TITLES}
+
+            for future in as_completed(futures):
+                title = futures[future]
+                # A savepoint per title lets one bad title roll back without losing the others
+                cur.execute("SAVEPOINT title_load")
+                try:
+                    count = insert_rows(title, future.result(), cur)
+                    cur.execute("RELEASE SAVEPOINT title_load")
+
+                    print(f"✅ Title {title}: inserted wordcount for {count} chapters")
+
+                except Exception as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT title_load")
+                    print(f"❌ Error processing Title {title}: {e}")
+
+        print("🔧 Creating indexes…")
+        cur.execute(CREATE_INDEX_SQL)
+        cur.execute("ANALYZE ecfr_chapter_wordcount")
+        conn.commit()
+
+        print("🎉 All titles processed.")
+    finally:
+        cur.close()
+        conn.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file